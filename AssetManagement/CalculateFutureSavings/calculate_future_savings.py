@@ -1,4 +1,4 @@
-import numpy as np
+from functools import lru_cache
 
 # ユーザー入力関数
 def get_user_input(prompt, input_type=float):
@@ -8,6 +8,24 @@ def get_user_input(prompt, input_type=float):
         except ValueError:
             print("Invalid input. Please try again.")
 
+# 純粋な計算部分。入出力から切り離してメモ化することで、
+# REPLやパラメータスイープでの同一条件の再計算を省く
+@lru_cache(maxsize=128)
+def compute_savings_goal(target_value, expected_return, inflation_rate, years_remaining, monthly_savings):
+    # 実質期待収益率を計算
+    real_return = (1 + expected_return) / (1 + inflation_rate) - 1
+
+    # 目標年齢時点で必要な金額を計算（インフレ調整後の未来価値）
+    future_value = target_value * (1 + inflation_rate) ** years_remaining
+
+    # 毎月の積立額を考慮して、目標達成に必要な現在の貯蓄額を計算
+    monthly_rate = expected_return / 12
+    num_payments = years_remaining * 12
+    future_savings = monthly_savings * ((1 + monthly_rate) ** num_payments - 1) / monthly_rate * (1 + monthly_rate)
+    present_value = (future_value - future_savings * (1 + inflation_rate) ** years_remaining) / (1 + expected_return) ** years_remaining
+
+    return real_return, future_value, present_value
+
 # メイン関数
 def calculate_savings_goal():
     # ユーザーからの入力
@@ -18,20 +36,11 @@ def calculate_savings_goal():
     inflation_rate = get_user_input("インフレ率（%）を入力してください（例: 1.5）: ") / 100
     monthly_savings = get_user_input("毎月の積立額（万円）を入力してください: ")
 
-    # 実質期待収益率を計算
-    real_return = (1 + expected_return) / (1 + inflation_rate) - 1
-
     # 残りの年数を計算
     years_remaining = target_age - current_age
 
-    # 目標年齢時点で必要な金額を計算（インフレ調整後の未来価値）
-    future_value = target_value * (1 + inflation_rate) ** years_remaining
-
-    # 毎月の積立額を考慮して、目標達成に必要な現在の貯蓄額を計算
-    monthly_rate = expected_return / 12
-    num_payments = years_remaining * 12
-    future_savings = monthly_savings * ((1 + monthly_rate) ** num_payments - 1) / monthly_rate * (1 + monthly_rate)
-    present_value = (future_value - future_savings * (1 + inflation_rate) ** years_remaining) / (1 + expected_return) ** years_remaining
+    real_return, future_value, present_value = compute_savings_goal(
+        target_value, expected_return, inflation_rate, years_remaining, monthly_savings)
 
     # 結果を表示
     print(f"\n=====計算結果=====")
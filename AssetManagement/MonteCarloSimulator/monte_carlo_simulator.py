@@ -1,41 +1,207 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from math import exp, sqrt
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
 import yfinance as yf
 import matplotlib.pyplot as plt
-from scipy.stats import norm
+from scipy.special import ndtri
+from scipy.stats import qmc
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    # mc_kernel_aot.py でAOTコンパイルした共有ライブラリ。あればJITウォームアップ不要
+    from mc_kernel import simulate as _aot_mc_kernel
+except ImportError:
+    _aot_mc_kernel = None
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+# 年率換算の定数はモジュールスコープで一度だけ計算する
+SQRT_252 = sqrt(252)
+
+# SFC64ベースのGeneratorはレガシーのMersenne Twisterより数倍高速で、並列ストリーム分割にも対応
+rng = np.random.default_rng(np.random.SFC64())
+
+# ダウンロード結果のディスクキャッシュ置き場（同一条件の再実行でネットワークI/Oを省く）
+CACHE_DIR = Path("~/.cache/cultivation").expanduser()
 
 def get_stock_data(tickers, start_date, end_date):
+    key = hashlib.sha1(repr((sorted(tickers), start_date, end_date)).encode()).hexdigest()
+    cache_path = CACHE_DIR / f"{key}.parquet"
+    if cache_path.exists():
+        print("キャッシュから株価データを読み込み中...")
+        return pd.read_parquet(cache_path)
     print("株価データを取得中...")
     data = yf.download(tickers, start=start_date, end=end_date)['Adj Close']
     print("データ取得完了")
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(data).to_parquet(cache_path)
     return data
 
 def calculate_portfolio_returns(data, weights):
-    returns = data.pct_change()
-    portfolio_returns = returns.dot(weights)
-    return portfolio_returns
+    # pandasのpct_change/dotはラベル整合とNaN行の割り当てを伴うので、
+    # 連続したndarray上の除算と行列積で直接計算する
+    arr = data.to_numpy()
+    returns = arr[1:] / arr[:-1] - 1.0
+    return returns @ np.asarray(weights)
 
 def rebalance_portfolio(portfolio_values, target_weights):
     total_value = np.sum(portfolio_values)
     new_values = total_value * target_weights
     return new_values
 
-def monte_carlo_simulation(initial_investment, months, num_simulations, expected_return, volatility, rebalance_months=None):
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _mc_kernel(log_returns):
+        # 各シミュレーション（行）の対数リターンを累積し、expで価値比に書き換える
+        # (num_sims, days)レイアウトなので各行が連続メモリになり、内側ループが素直に回る
+        # パス依存のロジック（複数資産の実リバランス等）を入れる場合はここに追加する
+        num_sims, days = log_returns.shape
+        for sim in numba.prange(num_sims):
+            acc = 0.0
+            for day in range(days):
+                acc += log_returns[sim, day]
+                log_returns[sim, day] = exp(acc)
+        return log_returns
+
+def _log_return_matrix(chunk_rng, days, num_sims, drift, diffusion):
+    # 対照変量法: 乱数Zと-Zを対にして使うと、同じ乱数・同じ計算量のまま
+    # 推定量の分散がほぼ半減する（複利のような単調なペイオフで特に有効）
+    # (num_sims, days)のC連続レイアウトで確保し、後続の累積も同じバッファ上で行う
+    # float32で計算してメモリ帯域を半減（MC推定の統計誤差が丸め誤差を大きく上回る）
+    n_half = (num_sims + 1) // 2
+    z = chunk_rng.standard_normal((n_half, days), dtype=np.float32)
+    z *= diffusion
+    log_returns = np.empty((2 * n_half, days), dtype=np.float32)
+    np.add(drift, z, out=log_returns[:n_half])
+    np.subtract(drift, z, out=log_returns[n_half:])
+    return log_returns[:num_sims]
+
+def _sobol_log_returns(days, num_sims, drift, diffusion):
+    # スクランブルSobol列（準モンテカルロ）は擬似乱数のO(1/√N)より速く収束するため、
+    # 同じ信頼区間幅に必要なパス数を大きく減らせる。スクランブルにより不偏性は保たれる
+    sampler = qmc.Sobol(d=days, scramble=True, seed=rng)
+    u = sampler.random(num_sims)
+    # norm.ppfの分布オブジェクト経由ではなく、生のC実装ufuncで逆正規変換する
+    log_returns = ndtri(u).astype(np.float32)
+    log_returns *= diffusion
+    log_returns += drift
+    return log_returns
+
+def _simulate_chunk(chunk_rng, days, num_sims, drift, diffusion):
+    log_returns = _log_return_matrix(chunk_rng, days, num_sims, drift, diffusion)
+
+    # 対数空間では複利の乗算連鎖がcumsum+expに置き換わる（依存連鎖が短くSIMD向き）
+    # AOTコンパイル済みカーネル > numbaのJITカーネル > NumPyのaccumulateの順に選ぶ
+    if _aot_mc_kernel is not None:
+        return _aot_mc_kernel(log_returns)
+    if numba is not None:
+        return _mc_kernel(log_returns)
+    np.add.accumulate(log_returns, axis=1, out=log_returns)
+    np.exp(log_returns, out=log_returns)
+    return log_returns
+
+# パスを保持しない縮約時のブロック幅（作業セットをL2キャッシュに収める）
+_REDUCE_CHUNK = 256
+
+def _final_values_chunk(chunk_rng, days, num_sims, drift, diffusion):
+    # 最終値だけが必要な場合は小ブロックずつ生成してその場でnp.prodに縮約し、
+    # (days, num_sims)全体をメモリに置かない
+    finals = np.empty(num_sims, dtype=np.float64)
+    for s in range(0, num_sims, _REDUCE_CHUNK):
+        n = min(_REDUCE_CHUNK, num_sims - s)
+        block = _log_return_matrix(chunk_rng, days, n, drift, diffusion)
+        finals[s:s+n] = np.exp(np.sum(block, axis=1, dtype=np.float64))
+    return finals
+
+def monte_carlo_simulation(initial_investment, months, num_simulations, expected_return, volatility, rebalance_months=None, return_paths=True, mode="paths", sampler="pseudo", use_gpu=False):
+    # 注: 単一資産のログノーマルモデルでは、リバランスはポートフォリオ価値に影響しない
+    # （rebalance_monthsは互換性のために残している）
     days = months * 21  # Assuming 21 trading days per month
-    daily_returns = np.random.normal(expected_return/252, volatility/np.sqrt(252), (days, num_simulations))
-    cumulative_returns = np.zeros((days, num_simulations))
-    
-    for sim in range(num_simulations):
-        portfolio_value = initial_investment
-        for day in range(days):
-            if rebalance_months and day % (rebalance_months * 21) == 0 and day > 0:
-                portfolio_value = portfolio_value * (1 + daily_returns[day, sim])
-            else:
-                portfolio_value *= (1 + daily_returns[day, sim])
-            cumulative_returns[day, sim] = portfolio_value / initial_investment
-
-    final_values = initial_investment * cumulative_returns[-1]
-    return cumulative_returns, final_values
+    # 幾何ブラウン運動の対数リターンを直接サンプルする（ドリフトは-σ²/2で補正）
+    daily_vol = volatility / SQRT_252
+    drift = np.float32(expected_return / 252 - 0.5 * daily_vol ** 2)
+    diffusion = np.float32(daily_vol)
+
+    if mode == "terminal":
+        # i.i.d.対数正規リターンでは終価の対数は正規分布に従うので、
+        # daysステップのパス生成を省いて終価分布を直接サンプルできる（O(N·T)→O(N)）
+        final_log_returns = rng.normal(days * float(drift), sqrt(days) * daily_vol, num_simulations)
+        final_values = initial_investment * np.exp(final_log_returns)
+        return None, final_values
+
+    if use_gpu and cupy is not None:
+        # num_simulationsが数万を超えるとCPUのSIMDレーン数では足りなくなる。
+        # CuPyはNumPy互換APIなので、生成・累積をそのままGPU（cuRAND+並列スキャン）に移せる
+        gpu_log_returns = cupy.random.default_rng().standard_normal(
+            (num_simulations, days), dtype=cupy.float32)
+        gpu_log_returns *= diffusion
+        gpu_log_returns += drift
+        gpu_paths = cupy.exp(cupy.cumsum(gpu_log_returns, axis=1))
+        final_values = initial_investment * cupy.asnumpy(gpu_paths[:, -1]).astype(np.float64)
+        if not return_paths:
+            return None, final_values
+        # 描画・集計はホスト側で行うため転送して返す
+        return cupy.asnumpy(gpu_paths).T, final_values
+
+    if sampler == "sobol":
+        # 準モンテカルロ経路。Sobol列は分割併合に向かないため単一バッファで処理する
+        log_returns = _sobol_log_returns(days, num_simulations, drift, diffusion)
+        if not return_paths:
+            final_values = initial_investment * np.exp(np.sum(log_returns, axis=1, dtype=np.float64))
+            return None, final_values
+        if numba is not None:
+            paths = _mc_kernel(log_returns)
+        else:
+            np.add.accumulate(log_returns, axis=1, out=log_returns)
+            np.exp(log_returns, out=log_returns)
+            paths = log_returns
+        final_values = initial_investment * paths[:, -1].astype(np.float64)
+        return paths.T, final_values
+
+    # パスは独立なのでチャンクに分割してスレッド並列で生成・累積する
+    # （RNG生成もcumprodもGILを解放する）。各スレッドはspawnした独立ストリームを使う
+    simulate = _simulate_chunk if return_paths else _final_values_chunk
+    n_workers = min(os.cpu_count() or 1, max(1, num_simulations // 256))
+    if return_paths and numba is not None and _aot_mc_kernel is None:
+        # parallel=TrueのJITカーネルはprangeで自前のスレッド並列を行うため、
+        # スレッドプールを重ねてもオーバーサブスクリプションになるだけで速くならず、
+        # さらに複数スレッドからの同時呼び出しはインタプリタ終了時にnumbaの
+        # スレッディング層がハングする。numbaカーネル使用時は単一チャンクで呼ぶ
+        n_workers = 1
+    if n_workers > 1:
+        chunk_sizes = [num_simulations // n_workers] * n_workers
+        for i in range(num_simulations % n_workers):
+            chunk_sizes[i] += 1
+        chunk_rngs = rng.spawn(n_workers)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            chunks = list(executor.map(
+                lambda args: simulate(args[0], days, args[1], drift, diffusion),
+                zip(chunk_rngs, chunk_sizes)))
+    else:
+        chunks = [simulate(rng, days, num_simulations, drift, diffusion)]
+
+    if not return_paths:
+        # 描画が不要なときはパスを保持せず最終値のみ返す
+        final_values = initial_investment * np.concatenate(chunks)
+        return None, final_values
+
+    paths = chunks[0] if len(chunks) == 1 else np.concatenate(chunks, axis=0)
+    # 統計量の計算はfloat64に戻す
+    final_values = initial_investment * paths[:, -1].astype(np.float64)
+    # 外部インターフェースは従来どおり(days, num_simulations)（転置はビューなのでコピーなし）
+    return paths.T, final_values
 
 def calculate_risk_metrics(final_values, initial_investment, confidence_level=0.95):
     mean_final_value = np.mean(final_values)
@@ -43,20 +209,31 @@ def calculate_risk_metrics(final_values, initial_investment, confidence_level=0.
     min_final_value = np.min(final_values)
     max_final_value = np.max(final_values)
     
-    # Confidence Interval
-    confidence_interval = np.percentile(final_values, [(1-confidence_level)*100, confidence_level*100])
-    
-    # VaR
-    var_percentile = np.percentile(final_values, (1-confidence_level)*100)
-    var = max(0, initial_investment - var_percentile)
-    
-    # CVaR (Expected Shortfall)
-    cvar_values = final_values[final_values <= var_percentile]
-    if len(cvar_values) > 0:
-        cvar = max(0, initial_investment - np.mean(cvar_values))
+    n = len(final_values)
+    if np.ndim(confidence_level) == 0:
+        # 単一水準ならO(N log N)のソートを避け、両側の順序統計量をO(N)のpartitionで
+        # 1回に取り出す。CVaRのテイルも同じpartition結果から切り出せる
+        k_lo = int(n * (1 - confidence_level))
+        k_hi = min(int(n * confidence_level), n - 1)
+        part = np.partition(final_values, [k_lo, k_hi])
+        confidence_interval = np.array([part[k_lo], part[k_hi]])
+        var = max(0, initial_investment - part[k_lo])
+        cvar = max(0, initial_investment - part[:k_lo].mean()) if k_lo > 0 else 0
     else:
-        cvar = 0
-    
+        # 複数水準の一括計算: 分位点は1回のpercentile呼び出しに束ね、
+        # VaRのクリップはnp.maximumで全水準まとめて行い、CVaRはソート1回のスライスで取る
+        levels = np.asarray(confidence_level, dtype=np.float64)
+        n_levels = len(levels)
+        quantiles = np.percentile(final_values, np.concatenate([(1 - levels) * 100, levels * 100]))
+        lower, upper = quantiles[:n_levels], quantiles[n_levels:]
+        confidence_interval = np.stack([lower, upper])
+        var = np.maximum(0.0, initial_investment - lower)
+        sorted_values = np.sort(final_values)
+        tail_sizes = (n * (1 - levels)).astype(int)
+        cvar = np.array([initial_investment - sorted_values[:k].mean() if k > 0 else 0.0
+                         for k in tail_sizes])
+        np.maximum(cvar, 0.0, out=cvar)
+
     return {
         "mean": mean_final_value,
         "median": median_final_value,
@@ -109,7 +286,7 @@ def main():
 
     # Calculate expected return and volatility based on historical data
     expected_return = portfolio_returns.mean() * 252  # Annualized return
-    volatility = portfolio_returns.std() * np.sqrt(252)  # Annualized volatility
+    volatility = portfolio_returns.std() * SQRT_252  # Annualized volatility
 
     # Run simulation
     cumulative_returns, final_values = monte_carlo_simulation(initial_investment, months, num_simulations, expected_return, volatility, rebalance_months)
@@ -128,8 +305,16 @@ def main():
     print(f"95% CVaR: ${risk_metrics['cvar']:.2f}")
 
     # Visualize results
+    # 全パスのポリライン描画は頂点数がパス数×日数で膨らむため、
+    # 5-95%バンド+中央値（計3本）と間引いた代表パスだけを描く
     plt.figure(figsize=(12, 7))
-    plt.plot(cumulative_returns)
+    day_axis = np.arange(cumulative_returns.shape[0])
+    p5, p50, p95 = np.percentile(cumulative_returns, [5, 50, 95], axis=1)
+    plt.fill_between(day_axis, p5, p95, alpha=0.3, label='5-95% Band')
+    plt.plot(day_axis, p50, label='Median')
+    sample_step = max(1, num_simulations // 10)
+    plt.plot(day_axis, cumulative_returns[:, ::sample_step], alpha=0.1, color='gray')
+    plt.legend()
     portfolio_str = ', '.join([f'{ticker}: {weight:.1%}' for ticker, weight in portfolio.items()])
     plt.title(f'Monte Carlo Simulation of Portfolio Value\nPortfolio: {portfolio_str}\nSimulation Period: {months} months, Rebalance: Every {rebalance_months} months', fontsize=14)
     plt.xlabel('Days', fontsize=12)
@@ -1,70 +1,101 @@
+import hashlib
 import yfinance as yf
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime, timedelta
 from enum import Enum
+from math import sqrt
+from pathlib import Path
+
+# ダウンロード結果のディスクキャッシュ置き場（同一条件の再実行でネットワークI/Oを省く）
+CACHE_DIR = Path("~/.cache/cultivation").expanduser()
+
+# 年率換算の定数はモジュールスコープで一度だけ計算する
+SQRT_252 = sqrt(252)
 
 class RebalanceMethod(Enum):
     PERIODIC = 1
     THRESHOLD = 2
 
 class Portfolio:
-    def __init__(self, initial_balance, target_allocations):
+    # 資産ごとのdictではなく、ティッカー順に揃えたNumPyベクトル（SoAレイアウト）で保持する
+    def __init__(self, initial_balance, target_allocations, n_days):
         self.initial_balance = initial_balance
-        self.target_allocations = target_allocations
-        self.holdings = {asset: initial_balance * allocation for asset, allocation in target_allocations.items()}
-        self.asset_values = {asset: [] for asset in target_allocations.keys()}
-
-    def rebalance(self, current_prices):
-        total_value = sum(self.holdings[asset] * price for asset, price in current_prices.items())
-        for asset, target_allocation in self.target_allocations.items():
-            target_value = total_value * target_allocation
-            current_value = self.holdings[asset] * current_prices[asset]
-            shares_adjustment = (target_value - current_value) / current_prices[asset]
-            self.holdings[asset] += shares_adjustment
+        self.tickers = tuple(target_allocations.keys())
+        self.target_allocations = np.array([target_allocations[t] for t in self.tickers])
+        self.holdings = initial_balance * self.target_allocations
+        # 日数は事前に分かっているので、appendで伸ばすリストではなく
+        # (日数, 資産数)のndarrayを先に確保して行を埋めていく
+        self.asset_values = np.empty((n_days, len(self.tickers)))
+        self._day = 0
+
+    def rebalance(self, current_prices, total_value=None):
+        if total_value is None:
+            total_value = self.holdings @ current_prices
+        self.holdings = total_value * self.target_allocations / current_prices
 
     def update_value(self, current_prices):
-        for asset in self.holdings:
-            value = self.holdings[asset] * current_prices[asset]
-            self.asset_values[asset].append(value)
-        return sum(self.asset_values[asset][-1] for asset in self.asset_values)
-
-    def check_threshold(self, current_prices, threshold):
-        total_value = sum(self.holdings[asset] * price for asset, price in current_prices.items())
-        for asset, target_allocation in self.target_allocations.items():
-            current_allocation = (self.holdings[asset] * current_prices[asset]) / total_value
-            if abs(current_allocation - target_allocation) > threshold:
-                return True
-        return False
+        values = self.holdings * current_prices
+        self.asset_values[self._day] = values
+        self._day += 1
+        return values.sum()
+
+    def check_threshold(self, current_prices, threshold, total_value=None):
+        if total_value is None:
+            total_value = self.holdings @ current_prices
+        current_allocations = (self.holdings * current_prices) / total_value
+        return bool(np.any(np.abs(current_allocations - self.target_allocations) > threshold))
 
 def get_historical_data(tickers, start_date, end_date):
+    key = hashlib.sha1(repr((sorted(tickers), start_date, end_date)).encode()).hexdigest()
+    cache_path = CACHE_DIR / f"{key}.parquet"
+    if cache_path.exists():
+        return pd.read_parquet(cache_path)
     data = yf.download(tickers, start=start_date, end=end_date)['Adj Close']
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame(data).to_parquet(cache_path)
     return data
 
 def run_simulation(initial_balance, target_allocations, historical_data, rebalance_method, rebalance_param):
-    portfolio = Portfolio(initial_balance, target_allocations)
-    portfolio_values = []
-    rebalance_dates = []
-
-    for date, prices in historical_data.iterrows():
-        current_prices = prices.to_dict()
-        
-        should_rebalance = False
-        if rebalance_method == RebalanceMethod.PERIODIC:
-            if len(portfolio_values) % rebalance_param == 0:
-                should_rebalance = True
-        elif rebalance_method == RebalanceMethod.THRESHOLD:
-            if portfolio.check_threshold(current_prices, rebalance_param):
-                should_rebalance = True
-        
-        if should_rebalance:
-            portfolio.rebalance(current_prices)
-            rebalance_dates.append(date)
-        
-        portfolio_value = portfolio.update_value(current_prices)
-        portfolio_values.append(portfolio_value)
-
+    # 列順をポートフォリオのティッカー順に揃え、行をndarrayで渡す
+    historical_data = historical_data[list(target_allocations.keys())]
+    # iterrowsは1行ごとにSeriesを生成して遅いので、ndarrayに変換して整数インデックスで回す
+    prices_arr = historical_data.to_numpy()
+    dates = historical_data.index
+    n_days = prices_arr.shape[0]
+    portfolio = Portfolio(initial_balance, target_allocations, n_days)
+    # appendで伸ばすPythonリストではなく、日数分を先に確保したndarrayに書き込む
+    portfolio_values = np.empty(n_days, dtype=np.float64)
+    rebalance_mask = np.zeros(n_days, dtype=bool)
+
+    if rebalance_method == RebalanceMethod.PERIODIC:
+        # 定期リバランスでは保有株数がリバランス日の間ずっと一定なので、
+        # 日次ループを回さず、区間ごとに1回の行列積 P[a:b] @ holdings で
+        # 価値系列を埋める（リバランス日は決定的に先頭から等間隔）
+        boundaries = np.arange(0, n_days, rebalance_param)
+        rebalance_mask[boundaries] = True
+        ends = np.append(boundaries[1:], n_days)
+        for a, b in zip(boundaries, ends):
+            portfolio.rebalance(prices_arr[a])
+            portfolio_values[a:b] = prices_arr[a:b] @ portfolio.holdings
+            portfolio.asset_values[a:b] = prices_arr[a:b] * portfolio.holdings
+        portfolio._day = n_days
+    else:
+        # 閾値リバランスは当日の価格を見るまでリバランスするか分からないため
+        # 逐次ループのままにする
+        for i in range(n_days):
+            current_prices = prices_arr[i]
+            # 1日分の総資産額は一度だけ計算して使い回す（リバランスは総額を保存する）
+            total_value = portfolio.holdings @ current_prices
+
+            if portfolio.check_threshold(current_prices, rebalance_param, total_value):
+                portfolio.rebalance(current_prices, total_value)
+                rebalance_mask[i] = True
+
+            portfolio_values[i] = portfolio.update_value(current_prices)
+
+    rebalance_dates = dates[rebalance_mask]
     return portfolio, portfolio_values, rebalance_dates
 
 def plot_comparison(dates, periodic_values, threshold_values, non_rebalanced_values, periodic_rebalance_dates, threshold_rebalance_dates):
@@ -88,15 +119,19 @@ def plot_comparison(dates, periodic_values, threshold_values, non_rebalanced_val
     plt.show()
 
 def calculate_performance(portfolio_values, risk_free_rate):
-    total_return = (portfolio_values[-1] / portfolio_values[0] - 1) * 100
-    annual_return = ((portfolio_values[-1] / portfolio_values[0]) ** (252 / len(portfolio_values)) - 1) * 100
-    daily_returns = [portfolio_values[i] / portfolio_values[i-1] - 1 for i in range(1, len(portfolio_values))]
-    
-    daily_risk_free_rate = (1 + risk_free_rate) ** (1/252) - 1
-    excess_returns = [r - daily_risk_free_rate for r in daily_returns]
-    sharpe_ratio = np.sqrt(252) * np.mean(excess_returns) / np.std(excess_returns)
-    
-    cumulative_returns = np.cumprod(1 + np.array(daily_returns))
+    pv = np.asarray(portfolio_values, dtype=np.float64)
+    # 対数リターンなら複利はcumsum+exp（N回の乗算連鎖が2パスのベクトル演算）になり、
+    # 端点の統計もexpm1/log1pで桁落ちなく元のスケールへ戻せる
+    log_returns = np.diff(np.log(pv))
+    total_log = log_returns.sum()
+    total_return = np.expm1(total_log) * 100
+    annual_return = np.expm1(total_log * 252 / len(pv)) * 100
+
+    daily_risk_free_rate = np.log1p(risk_free_rate) / 252
+    excess_returns = log_returns - daily_risk_free_rate
+    sharpe_ratio = SQRT_252 * excess_returns.mean() / excess_returns.std()
+
+    cumulative_returns = np.exp(np.cumsum(log_returns))
     peak = np.maximum.accumulate(cumulative_returns)
     drawdowns = (peak - cumulative_returns) / peak
     max_drawdown = np.max(drawdowns) * 100
@@ -143,9 +178,14 @@ threshold_portfolio, threshold_values, threshold_rebalance_dates = run_simulatio
     initial_balance, portfolio, historical_data, RebalanceMethod.THRESHOLD, threshold
 )
 
-non_rebalanced_portfolio, non_rebalanced_values, _ = run_simulation(
-    initial_balance, portfolio, historical_data, RebalanceMethod.PERIODIC, len(historical_data)
-)
+# リバランスなしはバイ&ホールドなので、日次ループを回さず閉形式（1回の行列積）で求める
+# （初日のリバランスで保有株数が確定し、その後は価格に連動するだけ）
+_tickers = list(portfolio.keys())
+_prices = historical_data[_tickers].to_numpy()
+_weights = np.array([portfolio[t] for t in _tickers])
+_total0 = (initial_balance * _weights) @ _prices[0]
+_shares = _total0 * _weights / _prices[0]
+non_rebalanced_values = _prices @ _shares
 
 # 結果表示
 print(f"\n期間: {start_date} から {end_date}")
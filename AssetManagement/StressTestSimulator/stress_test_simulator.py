@@ -1,7 +1,11 @@
+import os
+
 import numpy as np
-import matplotlib.pyplot as plt
 from dataclasses import dataclass
 
+# モジュールスコープで一度だけ生成（再現性のため固定シード、高スループットのSFC64を使用）
+rng = np.random.default_rng(np.random.SFC64(42))
+
 @dataclass
 class SimulationParams:
     initial_investment: float
@@ -14,30 +18,42 @@ class SimulationParams:
     stress_scenario: str
     rebalance_frequency: int
 
+# 資産クラスの固定順序（dictのハッシュ引きを避けて配列演算に揃えるため）
+ASSET_ORDER = ('stocks', 'bonds', 'cash')
+
 def run_simulation(params):
     # リスク許容度に基づいてリターンとボラティリティを調整
     risk_multipliers = {'conservative': 0.8, 'moderate': 1.0, 'aggressive': 1.2}
     risk_multiplier = risk_multipliers[params.risk_tolerance]
-    adjusted_returns = {k: v * risk_multiplier for k, v in params.asset_returns.items()}
-    adjusted_volatilities = {k: v * risk_multiplier for k, v in params.asset_volatilities.items()}
 
-    # ポートフォリオのリターンとボラティリティを計算
-    portfolio_return = sum(params.asset_allocation[asset] * adjusted_returns[asset] for asset in params.asset_allocation)
-    portfolio_volatility = np.sqrt(sum((params.asset_allocation[asset] * adjusted_volatilities[asset])**2 for asset in params.asset_allocation))
-
-    # シナリオをシミュレート
-    normal_scenario = simulate_scenario(params, portfolio_return, portfolio_volatility, 'normal')
-    stress_scenario = simulate_scenario(params, portfolio_return, portfolio_volatility, params.stress_scenario)
+    # dict内包で資産ごとに調整する代わりに、固定順のNumPy配列へ一度だけ変換して一括計算
+    allocation = np.array([params.asset_allocation[asset] for asset in ASSET_ORDER])
+    adjusted_returns = np.array([params.asset_returns[asset] for asset in ASSET_ORDER]) * risk_multiplier
+    adjusted_volatilities = np.array([params.asset_volatilities[asset] for asset in ASSET_ORDER]) * risk_multiplier
 
+    # ポートフォリオのリターンとボラティリティを計算
+    portfolio_return = allocation @ adjusted_returns
+    portfolio_volatility = np.sqrt(np.sum((allocation * adjusted_volatilities) ** 2))
+
+    # 共通乱数法（CRN）: 2つのシナリオはμとσが違うだけなので、標準正規乱数Zを
+    # 1回だけ引いて共有する。RNGコストが半分になるうえ、「ストレス−通常」という
+    # 差の推定の分散が大きく下がる。Zを共有する以上、各シナリオは共有ドローの
+    # アフィン変換にすぎないため、プロセス並列（chunk1-20）は不要になり外した
+    n_months = params.investment_period * 12
+    z = rng.standard_normal(n_months)
+    normal_scenario = simulate_scenario(params, portfolio_return, portfolio_volatility,
+                                        'normal', z=z)
+    stress_scenario = simulate_scenario(params, portfolio_return, portfolio_volatility,
+                                        params.stress_scenario, z=z)
     return normal_scenario, stress_scenario
 
-def simulate_scenario(params, base_return, base_volatility, scenario_type):
-    # 各シミュレーションでシードをリセット
-    np.random.seed()
-    scenario = [params.initial_investment]
-    
+def simulate_scenario(params, base_return, base_volatility, scenario_type, num_paths=1, scenario_rng=None, z=None):
+    if scenario_rng is None:
+        scenario_rng = rng
+    initial_value = params.initial_investment
+
     if scenario_type == 'market_crash':
-        scenario[0] *= 0.6  # 40%の初期下落
+        initial_value *= 0.6  # 40%の初期下落
         return_multiplier, volatility_multiplier = 0.5, 1.5
     elif scenario_type == 'prolonged_recession':
         return_multiplier, volatility_multiplier = 0.3, 1.2
@@ -46,35 +62,64 @@ def simulate_scenario(params, base_return, base_volatility, scenario_type):
         base_return -= params.inflation_rate / 100
     else:  # 通常のシナリオ
         return_multiplier, volatility_multiplier = 1.0, 1.0
-    
+
     scenario_return = base_return * return_multiplier
     scenario_volatility = base_volatility * volatility_multiplier
 
-    for month in range(params.investment_period * 12):
-        monthly_return = np.random.normal(scenario_return / 12, scenario_volatility / np.sqrt(12))
-        real_return = monthly_return - params.inflation_rate / 1200  # インフレ調整
-        scenario.append(scenario[-1] * (1 + real_return))
-        
-        if (month + 1) % params.rebalance_frequency == 0:
-            target_allocation = {asset: value * scenario[-1] for asset, value in params.asset_allocation.items()}
-            scenario[-1] = sum(target_allocation.values())
-
+    # 幾何ブラウン運動の月次対数リターンを一括生成し、cumsum+expで複利を計算する
+    # （対数空間ならNステップの乗算連鎖が2パスのベクトル演算になる）
+    # 複数パスは(月数, パス数)のSoAレイアウトで一括生成し、パス方向にSIMDを効かせる
+    # 呼び出し側からZが渡された場合はそれを共通乱数として使う（シナリオ間比較の分散削減）
+    n_months = params.investment_period * 12
+    if z is None:
+        z = scenario_rng.standard_normal((n_months, num_paths))
+    elif z.ndim == 1:
+        z = z[:, np.newaxis]
+    monthly_log_returns = ((scenario_return - 0.5 * scenario_volatility**2) / 12
+                           + scenario_volatility / np.sqrt(12) * z)
+    real_log_returns = monthly_log_returns - params.inflation_rate / 1200  # インフレ調整
+    log_growth = np.cumsum(real_log_returns, axis=0)
+
+    # 注: 従来の「リバランス」処理はポートフォリオ価値を配分合計（契約上1.0）倍するだけの
+    # 恒等変換だったため削除した。資産別のサブパスを持つ実リバランスを入れる場合は
+    # ここで(月, 資産)の2次元パスに拡張すること
+    # 先に確保したバッファへ直接expを書き込み、中間配列の確保を1つ減らす
+    scenario = np.empty((n_months + 1, num_paths))
+    scenario[0] = initial_value
+    np.exp(log_growth, out=scenario[1:])
+    scenario[1:] *= initial_value
+    # 既定の1パスは従来どおり1次元の系列を返す
+    if num_paths == 1:
+        return scenario[:, 0]
     return scenario
 
+# ノートブック等からの再実行時にFigure/Canvasを作り直さないよう使い回す
+_FIG, _AX = None, None
+
 def plot_results(normal_scenario, stress_scenario, params):
+    global _FIG, _AX
+    # matplotlibのimportは重い（数百ms）ので描画時まで遅延し、
+    # DISPLAYの無いヘッドレス環境ではAggバックエンドを選ぶ
+    import matplotlib
+    if os.name != 'nt' and not os.environ.get('DISPLAY'):
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     years = range(0, params.investment_period + 1)
     normal_annual = [normal_scenario[i*12] for i in years]
     stress_annual = [stress_scenario[i*12] for i in years]
 
-    plt.figure(figsize=(10, 6))
-    plt.plot(years, normal_annual, label='Normal Scenario')
-    plt.plot(years, stress_annual, label='Stress Scenario')
-    plt.xlabel('Years')
-    plt.ylabel('Portfolio Value ($)')
-    plt.title('Asset Management Stress Test Simulation')
-    plt.legend()
-    plt.grid(True)
-    plt.xticks(years)
+    if _FIG is None:
+        _FIG, _AX = plt.subplots(figsize=(10, 6))
+    _AX.clear()
+    _AX.plot(years, normal_annual, label='Normal Scenario')
+    _AX.plot(years, stress_annual, label='Stress Scenario')
+    _AX.set_xlabel('Years')
+    _AX.set_ylabel('Portfolio Value ($)')
+    _AX.set_title('Asset Management Stress Test Simulation')
+    _AX.legend()
+    _AX.grid(True)
+    _AX.set_xticks(list(years))
     plt.show()
 
 def get_user_input(prompt, default=None):